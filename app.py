@@ -1,25 +1,39 @@
 import os
-import httpx
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+import asyncio
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.middleware import SlowAPIMiddleware
+from slowapi.util import get_remote_address
 import logging
-import json
+from typing import Union
+import orjson
+
+# Настройка на логването - преди импортите на пакета, за да се виждат и грешките при зареждането му
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Импортиране на функции от weather_data.py
-from weather_data import (
-    get_historical_weather,
-    get_forecast_weather,
-    format_historical_data,
-    format_forecast_data
-)
+from weather_data import get_all_weather
 from video_analysis import analyze_video_stream
+from weather_api import ANTHROPIC_MODEL, analyze_weather_trend, iter_weather_trend
+from weather_api.client import get_client, close_http_client
+from weather_api.single_flight import single_flight
 
-# Настройка на логването
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+app = FastAPI(title="Weather Trend Analysis", default_response_class=ORJSONResponse)
+
+# Общият HTTP клиент се създава при стартиране и се затваря при спиране на приложението
+app.add_event_handler("startup", get_client)
+app.add_event_handler("shutdown", close_http_client)
 
-app = FastAPI(title="Weather Trend Analysis")
+# Ограничение на заявките по IP - /weather-trend вика платени външни API
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_middleware(SlowAPIMiddleware)
 
 # Добавяне на CORS middleware
 app.add_middleware(
@@ -30,258 +44,169 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Изтегляне на ключовете от секретите на Hugging Face Spaces
+# Изтегляне на ключа от секретите на Hugging Face Spaces
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-
-# Проверка дали API ключовете са налични
-if not WEATHER_API_KEY:
-    logger.error("WEATHER_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face Spaces.")
-    
-if not ANTHROPIC_API_KEY:
-    logger.error("ANTHROPIC_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face Spaces.")
-
-# Конфигурация на Anthropic модела
-ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
-ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
-
-async def analyze_weather_trend(historical_data, forecast_data, video_analysis_text):
-    """Изпраща данни към Anthropic API за анализ на тренда"""
-    try:
-        if not ANTHROPIC_API_KEY:
-            logger.error("ANTHROPIC_API_KEY не е наличен")
-            # Извличаме текущата температура от прогнозните данни
-            current_temp = forecast_data.get("current", {}).get("temp_c", "N/A")
-            return {
-                "анализ": f"[!] AI анализът временно недостъпен (липсва API ключ). Базовите данни показват температура от {current_temp}°C в Обзор.",
-                "влияние": "[!] Поради липса на AI анализ, препоръчваме да следите метеорологичните условия от стандартната прогноза.",
-                "слънчев_ден": "[!] AI оценката за 'слънчев ден' не е налична поради липсващ API ключ.",
-                "статус": "error",
-                "error_details": "Липсва ANTHROPIC_API_KEY"
-            }
-
-        headers = {
-            "x-api-key": ANTHROPIC_API_KEY,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json"
-        }
-        
-        # Форматиране на историческите данни
-        historical_text = format_historical_data(historical_data)
-        
-        # Форматиране на прогнозните данни
-        forecast_text = format_forecast_data(forecast_data)
-        
-        # Изграждане на заявката към Claude
-        # Гарантираме, че всички параметри са низове
-        video_analysis_text_safe = video_analysis_text if video_analysis_text is not None else ""
-        historical_text_safe = historical_text if historical_text is not None else ""
-        forecast_text_safe = forecast_text if forecast_text is not None else ""
-
-        prompt = f"""
-        Задача: Ти си професионален метеоролог, който представя времето за Обзор (древния Хелиополис) с балансирана комбинация от точност и топлота. Говориш уверено и информативно, с елегантни препратки към историята на града.
-
-Текущ кадър от Обзор: {video_analysis_text_safe}
-
-Исторически данни (вчера): {historical_text_safe}
-
-Прогнозни данни (днес и утре): {forecast_text_safe}
-
-Моля, представи кратък и точен анализ в три части (всяка до 2-3 изречения):
 
-1. Текущо време:
-- Опиши основните характеристики: температура, облачност, морски условия
-- Сравни с вчерашния ден, отбележи значими промени
-- Избягвай прекалено поетични описания
-
-2. Влияние върху хората:
-- Как времето влияе на ежедневните дейности
-- Кратък, практичен съвет за деня
-- Фокусирай се върху полезна информация
-
-3. Оценка на "слънчевия ден":
-- Кратка оценка дали денят е "слънчев" според дефиницията
-- Елегантна препратка към историята на Хелиополис
-- Без излишна драматизация
-
-Важни изисквания:
-• Поддържай професионален, но достъпен тон
-• Избягвай прекалена емоционалност или "сладникави" описания
-• Фокусирай се върху точност и полезност
-• Включвай само релевантни детайли
-• Пази баланс между информативност и достъпност
-
-Отговорът трябва да е на български език, стегнат и професионален, без излишни украшения или преиграване.
-        """
-        
-        # Логваме prompt-а преди изпращане
-        logger.info(f"Изпращане на prompt към Anthropic API: {repr(prompt)}")
-
-        payload = {
-            "model": ANTHROPIC_MODEL,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 500,
-            "temperature": 0.2
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                ANTHROPIC_API_URL, 
-                json=payload,
-                headers=headers,
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Грешка от Anthropic API: {response.text}")
-                error_msg = f"Технически проблем с AI анализа (код: {response.status_code})"
-                return {
-                    "анализ": f"[!] {error_msg}. В момента в древния Град на Слънцето времето е приятно за разходки, но нашите системи временно не могат да предоставят детайлен анализ.",
-                    "влияние": "[!] Поради техническа поддръжка на AI системите, моля проверете прогнозата от други източници. Междувременно можете да се насладите на морския бриз.",
-                    "слънчев_ден": "[!] Временно недостъпна информация поради технически проблем с AI анализа.",
-                    "статус": "error",
-                    "error_details": error_msg
-                }
-            
-            result = response.json()
-            logger.info(f"Пълен отговор от Anthropic API: {result}")
-            
-            # Извличане на съдържанието от отговора на Anthropic
-            content = result.get("content", [])
-            if not content:
-                logger.error("Няма съдържание в отговора от Anthropic")
-                raise Exception("Празен отговор от AI модела")
-                
-            generated_text = content[0].get("text", "")
-            logger.info(f"Извлечен текст от отговора: {generated_text}")
-            
-            # Разделяне и обработка на отговора
-            try:
-                # Разделяме текста на параграфи
-                paragraphs = [p.strip() for p in generated_text.split('\n\n') if p.strip()]
-                logger.info(f"Разделени параграфи: {paragraphs}")
-                
-                # Търсим съответните секции по ключови думи
-                analysis = ""
-                influence = ""
-                sunny_day = ""
-                
-                for p in paragraphs:
-                    p_lower = p.lower()
-                    # Премахваме номерация и маркери
-                    p = p.replace("1.", "").replace("2.", "").replace("3.", "").strip()
-                    p = p.replace("1)", "").replace("2)", "").replace("3)", "").strip()
-                    
-                    if not analysis and ("време" in p_lower or "небе" in p_lower or "температура" in p_lower):
-                        analysis = p
-                    elif not influence and ("влияние" in p_lower or "усещане" in p_lower or "настроение" in p_lower):
-                        influence = p
-                    elif not sunny_day and ("слънчев" in p_lower or "хелиополис" in p_lower):
-                        sunny_day = p
-                
-                # Ако не сме намерили някоя секция, вземаме параграфите подред
-                if not analysis and paragraphs:
-                    analysis = paragraphs[0]
-                if not influence and len(paragraphs) > 1:
-                    influence = paragraphs[1]
-                if not sunny_day and len(paragraphs) > 2:
-                    sunny_day = paragraphs[2]
-                
-                # Ако все още нямаме някоя секция, използваме подходящо съобщение
-                if not analysis:
-                    analysis = "Времето в момента е приятно за разходка из древния Град на Слънцето."
-                if not influence:
-                    influence = "Условията предразполагат към приятни разходки и активности на открито."
-                if not sunny_day:
-                    sunny_day = "Денят носи типичното за Хелиополис слънчево настроение."
-                
-                logger.info(f"Обработен отговор: Анализ: {analysis}, Влияние: {influence}, Слънчев ден: {sunny_day}")
-                
-            except Exception as e:
-                logger.error(f"Грешка при обработка на отговора: {str(e)}")
-                analysis = "В момента в древния Град на Слънцето времето е приятно, с лек морски бриз и променлива облачност."
-                influence = "Атмосферата предразполага към спокойни разходки покрай морето, където шумът на вълните създава усещане за безметежност."
-                sunny_day = "Въпреки променливата облачност, Хелиополис не губи своя слънчев характер, напомняйки ни за древната си история като Град на Слънцето."
-            
-            return {
-                "анализ": analysis,
-                "влияние": influence,
-                "слънчев_ден": sunny_day
-            }
-    except Exception as e:
-        logger.error(f"Грешка при анализ на тренда: {str(e)}")
-        error_msg = f"Системна грешка: {str(e)}"
-        return {
-            "анализ": f"[!] {error_msg}. Базовите ни системи показват типично крайморско време в Хелиополис.",
-            "влияние": "[!] Поради технически проблем не можем да предоставим детайлен анализ. Моля, проверете други източници.",
-            "слънчев_ден": "[!] Временно недостъпна информация поради системна грешка.",
-            "статус": "error",
-            "error_details": error_msg
-        }
+async def validate_weather_api_key():
+    """Проверява веднъж при стартиране дали API ключът е наличен"""
+    if not WEATHER_API_KEY:
+        logger.error("WEATHER_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face Spaces.")
+
+app.add_event_handler("startup", validate_weather_api_key)
+
+# Ключове в /weather-trend/stream за всяка секция от анализа и за статуса при грешка
+_STREAM_KEYS = {
+    "видео_анализ": "видео_анализ",
+    "анализ": "анализ_на_времето",
+    "влияние": "влияние_върху_хората",
+    "слънчев_ден": "слънчев_ден",
+    "статус": "статус",
+    "error_details": "error_details",
+    "from_cache": "from_cache"
+}
+
+# Началната страница е статична - изграждаме отговора веднъж при зареждане
+_ROOT_RESP = HTMLResponse(content="""
+<html>
+    <head>
+        <title>Weather Trend API</title>
+    </head>
+    <body>
+        <h1>Weather Trend API</h1>
+        <p>API за анализ на тенденциите на времето с помощта на Claude AI</p>
+        <p>Използвайте <a href="/weather-trend?location=Obzor,Bulgaria">/weather-trend?location=Obzor,Bulgaria</a> за получаване на анализ</p>
+    </body>
+</html>
+""")
 
 @app.get("/")
 async def root():
     """Начална страница с информация за API"""
-    html_content = """
-    <html>
-        <head>
-            <title>Weather Trend API</title>
-        </head>
-        <body>
-            <h1>Weather Trend API</h1>
-            <p>API за анализ на тенденциите на времето с помощта на Claude AI</p>
-            <p>Използвайте <a href="/weather-trend?location=Obzor,Bulgaria">/weather-trend?location=Obzor,Bulgaria</a> за получаване на анализ</p>
-        </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
-
-@app.get("/weather-trend")
-async def weather_trend(location: str = "8250 Obzor, Bulgaria"):
+    return _ROOT_RESP
+
+class WeatherTrendResponse(BaseModel):
+    """Отговор на /weather-trend"""
+    location: str = Field(alias="местоположение")
+    country: str = Field(alias="държава")
+    current_temperature: Union[float, str] = Field(alias="текуща_температура")
+    current_condition: str = Field(alias="текущо_състояние")
+    video_analysis: str = Field(alias="видео_анализ")
+    weather_analysis: str = Field(alias="анализ_на_времето")
+    impact_on_people: str = Field(alias="влияние_върху_хората")
+    sunny_day: str = Field(alias="слънчев_ден")
+    # Дали анализът е взет от кеша, без нова заявка към Claude
+    from_cache: bool = False
+
+# Задачи за /weather-trend в изпълнение по локация - едновременните дубликати чакат общ резултат
+_inflight = {}
+
+async def _collect_weather_inputs(location):
+    """Извлича паралелно историческите данни, прогнозата и анализа на видео потока"""
+    # Историческите данни са за предишния ден, прогнозата - за следващите 2 дни
+    video_stream_url = "https://restream.obzorweather.com/ad508abf-ee51-4e32-b223-70c463b05587.html"
+    weather, video_analysis_text = await asyncio.gather(
+        get_all_weather(location, 2, WEATHER_API_KEY),
+        analyze_video_stream(video_stream_url),
+        return_exceptions=True
+    )
+
+    # Без метеорологични данни няма какво да анализираме
+    if isinstance(weather, Exception):
+        raise weather
+    historical_data, forecast_data = weather
+
+    # При неуспех на видео анализа продължаваме с наличните данни
+    if isinstance(video_analysis_text, Exception):
+        logger.error("Анализът на видео потока не е наличен: %s", video_analysis_text)
+        video_analysis_text = "[!] Анализът на видео потока временно не е наличен."
+
+    return historical_data, forecast_data, video_analysis_text
+
+def _weather_summary(forecast_data):
+    """Извлича основната информация за отговора от прогнозните данни"""
+    # Без прогнозни данни полетата остават "Неизвестно"
+    forecast_data = forecast_data or {}
+    location_info = forecast_data.get("location", {})
+    current_info = forecast_data.get("current", {})
+    return {
+        "местоположение": location_info.get("name", "Неизвестно"),
+        "държава": location_info.get("country", "Неизвестно"),
+        "текуща_температура": current_info.get("temp_c", "N/A"),
+        "текущо_състояние": current_info.get("condition", {}).get("text", "Неизвестно")
+    }
+
+async def _build_weather_trend(location):
+    """Събира данните и анализа на тренда в отговора на /weather-trend"""
+    historical_data, forecast_data, video_analysis_text = await _collect_weather_inputs(location)
+    
+    # Анализираме тренда с Anthropic Claude
+    trend_analysis = await analyze_weather_trend(historical_data, forecast_data, video_analysis_text)
+    
+    return {
+        **_weather_summary(forecast_data),
+        # Видео анализът, с който е изготвен анализът - при кеширан анализ е от по-ранен кадър
+        "видео_анализ": trend_analysis.get("видео_анализ", video_analysis_text),
+        "анализ_на_времето": trend_analysis.get("анализ", "Няма наличен анализ"),
+        "влияние_върху_хората": trend_analysis.get("влияние", "Няма информация за влиянието"),
+        "слънчев_ден": trend_analysis.get("слънчев_ден", "Няма информация"),
+        "from_cache": trend_analysis.get("from_cache", False)
+    }
+
+@app.get("/weather-trend", response_model=WeatherTrendResponse)
+@limiter.limit("10/minute")
+async def weather_trend(request: Request, location: str = "8250 Obzor, Bulgaria"):
     """Анализира тренда на времето на базата на исторически данни, прогнози и видео поток"""
     try:
-        # Извличаме исторически данни за предишния ден
-        historical_data = await get_historical_weather(location, WEATHER_API_KEY)
-        
-        # Извличаме прогнозни данни за следващите 2 дни
-        forecast_data = await get_forecast_weather(location, 2, WEATHER_API_KEY)
+        # Едновременните заявки за една и съща локация чакат вече започналата
+        key = location.lower().strip()
+        return await asyncio.shield(single_flight(_inflight, key, lambda: _build_weather_trend(location)))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Неочаквана грешка: %s", e)
+        raise HTTPException(status_code=500, detail=f"Неочаквана грешка: {str(e)}")
 
-        # Анализираме видео потока
-        video_stream_url = "https://restream.obzorweather.com/ad508abf-ee51-4e32-b223-70c463b05587.html"
-        video_analysis_text = await analyze_video_stream(video_stream_url)
-        
-        # Анализираме тренда с Anthropic Claude
-        trend_analysis = await analyze_weather_trend(historical_data, forecast_data, video_analysis_text)
-        
-        # Извличаме основна информация за отговора
-        location_info = forecast_data.get("location", {})
-        current_info = forecast_data.get("current", {})
-        
-        # Връщаме резултата
-        return {
-            "местоположение": location_info.get("name", "Неизвестно"),
-            "държава": location_info.get("country", "Неизвестно"),
-            "текуща_температура": current_info.get("temp_c", "N/A"),
-            "текущо_състояние": current_info.get("condition", {}).get("text", "Неизвестно"),
-            "видео_анализ": video_analysis_text,
-            "анализ_на_времето": trend_analysis.get("анализ", "Няма наличен анализ"),
-            "влияние_върху_хората": trend_analysis.get("влияние", "Няма информация за влиянието"),
-            "слънчев_ден": trend_analysis.get("слънчев_ден", "Няма информация")
-        }
+@app.get("/weather-trend/stream")
+@limiter.limit("10/minute")
+async def weather_trend_stream(request: Request, location: str = "8250 Obzor, Bulgaria"):
+    """Като /weather-trend, но връща NDJSON поток - всяка секция от анализа се изпраща веднага щом е готова"""
+    try:
+        historical_data, forecast_data, video_analysis_text = await _collect_weather_inputs(location)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Неочаквана грешка: {str(e)}")
+        logger.error("Неочаквана грешка: %s", e)
         raise HTTPException(status_code=500, detail=f"Неочаквана грешка: {str(e)}")
 
+    async def events():
+        # Видео анализът идва от iter_weather_trend, за да съвпада с анализа и при попадение в кеша
+        yield orjson.dumps(_weather_summary(forecast_data)) + b"\n"
+        async for name, value in iter_weather_trend(historical_data, forecast_data, video_analysis_text):
+            if name in _STREAM_KEYS:
+                yield orjson.dumps({_STREAM_KEYS[name]: value}) + b"\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+# Отговорът на /health не се променя - изграждаме го веднъж при зареждане
+_HEALTH = ORJSONResponse({"status": "healthy", "version": "1.0.0", "model": ANTHROPIC_MODEL})
+
 @app.get("/health")
 async def health():
     """Проверка на състоянието на API"""
-    return {"status": "healthy", "version": "1.0.0", "model": ANTHROPIC_MODEL}
+    return _HEALTH
 
 # Добавяме конфигурация за стартиране на приложението
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=7860)
+    # uvloop и httptools за по-бърз event loop и HTTP парсер. Един процес, както в Dockerfile -
+    # ограничението на заявките, обединяването и кешовете са в паметта на процеса
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=7860,
+        loop="uvloop",
+        http="httptools",
+        # Зад reverse proxy-то на Hugging Face Spaces адресът на клиента идва от X-Forwarded-For
+        proxy_headers=True,
+        forwarded_allow_ips="*"
+    )
@@ -1,13 +1,34 @@
-import httpx
+import asyncio
 import logging
 import random
-from datetime import datetime
+import time
+import httpx
 from fastapi import HTTPException
+from weather_api.client import get_client
 
-# Настройка на логването
-logging.basicConfig(level=logging.INFO)
+# Логването се настройва от входната точка на приложението
 logger = logging.getLogger(__name__)
 
+# Последната форматирана минута - в рамките на една минута низът се преизползва
+_last_minute_ts = 0
+_last_minute_str = ""
+
+def _current_minute():
+    """Връща текущия час във формат ЧЧ:ММ, като го форматира най-много веднъж в минута"""
+    global _last_minute_ts, _last_minute_str
+    minute = int(time.time() // 60)
+    if minute != _last_minute_ts:
+        _last_minute_str = time.strftime("%H:%M")
+        _last_minute_ts = minute
+    return _last_minute_str
+
+# Шаблони на отговорите - неуспешен достъп, симулиран анализ и грешка; попълва се само часът
+_TEMPLATES = (
+    "текущия кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {t} ч., но за съжаление в момента нямаме достъп до видео потока",
+    "[Симулиран анализ] текущия кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {t} ч. На изображението се вижда {weather}. Морето е {sea}. (Забележка: В момента се използва симулация на анализа, реалният видео поток не е интегриран)",
+    "[!] Грешка при анализ на видео потока: {e}. Текущият кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {t} ч."
+)
+
 async def analyze_video_stream(stream_url: str) -> str:
     """
     Анализира видео поток от уеб камера в Обзор.
@@ -18,37 +39,44 @@ async def analyze_video_stream(stream_url: str) -> str:
     Returns:
         str: Описание на текущите визуални условия
     """
+    # Часът се изчислява преди try, за да е наличен и при грешка
+    current_time = _current_minute()
+    
     try:
-        current_time = datetime.now().strftime("%H:%M")
+        client = await get_client()
+        # Проверяваме само статуса - тялото на потока не се изтегля
+        async with client.stream("GET", stream_url, timeout=httpx.Timeout(10.0, connect=2.0)) as response:
+            status_code = response.status_code
+        
+        if status_code != 200:
+            logger.error("Грешка при достъп до видео потока: %s", status_code)
+            return _TEMPLATES[0].format(t=current_time)
+        
+        # Симулираме анализ на видео потока с базова информация за времето
+        # В реална имплементация тук би имало анализ на изображението
+        weather_conditions = [
+            "кристално ясно небе с няколко пухкави облачета, танцуващи на хоризонта",
+            "приятна частична облачност, през която слънчевите лъчи създават красива игра на светлина и сянка",
+            "плътна облачна покривка, която обгръща града в нежна прегръдка",
+            "лека морска мъгла, която придава мистичен вид на крайбрежието",
+            "безоблачно и ярко слънчево небе, типично за древния Град на Слънцето"
+        ]
+        sea_conditions = [
+            "спокойно море с нежни вълни, които галят брега",
+            "море с умерено вълнение, чийто ритмичен шепот се носи във въздуха",
+            "развълнувано море, чиито бели гребени рисуват красиви шарки по повърхността",
+            "изключително спокойно море, гладко като стъкло, отразяващо небесната красота"
+        ]
+        
+        weather = random.choice(weather_conditions)
+        sea = random.choice(sea_conditions)
+        
+        return _TEMPLATES[1].format(t=current_time, weather=weather, sea=sea)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(stream_url, timeout=10.0)
-            
-            if response.status_code != 200:
-                logger.error(f"Грешка при достъп до видео потока: {response.status_code}")
-                return f"текущия кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {current_time} ч., но за съжаление в момента нямаме достъп до видео потока"
-            
-            # Симулираме анализ на видео потока с базова информация за времето
-            # В реална имплементация тук би имало анализ на изображението
-            weather_conditions = [
-                "кристално ясно небе с няколко пухкави облачета, танцуващи на хоризонта",
-                "приятна частична облачност, през която слънчевите лъчи създават красива игра на светлина и сянка",
-                "плътна облачна покривка, която обгръща града в нежна прегръдка",
-                "лека морска мъгла, която придава мистичен вид на крайбрежието",
-                "безоблачно и ярко слънчево небе, типично за древния Град на Слънцето"
-            ]
-            sea_conditions = [
-                "спокойно море с нежни вълни, които галят брега",
-                "море с умерено вълнение, чийто ритмичен шепот се носи във въздуха",
-                "развълнувано море, чиито бели гребени рисуват красиви шарки по повърхността",
-                "изключително спокойно море, гладко като стъкло, отразяващо небесната красота"
-            ]
-            
-            weather = random.choice(weather_conditions)
-            sea = random.choice(sea_conditions)
-            
-            return f"[Симулиран анализ] текущия кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {current_time} ч. На изображението се вижда {weather}. Морето е {sea}. (Забележка: В момента се използва симулация на анализа, реалният видео поток не е интегриран)"
-            
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        # Очакваните мрежови грешки връщат текст, с който анализът на времето продължава
+        logger.error("Грешка при анализ на видео потока: %s", e)
+        return _TEMPLATES[2].format(t=current_time, e=e)
     except Exception as e:
-        logger.error(f"Грешка при анализ на видео потока: {str(e)}")
-        return f"[!] Грешка при анализ на видео потока: {str(e)}. Текущият кадър е заснет в Обзор (древният Хелиополис — Градът на Слънцето) в {current_time} ч."
+        logger.error("Неочаквана грешка при анализ на видео потока: %s", e)
+        raise
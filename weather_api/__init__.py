@@ -0,0 +1,6 @@
+from weather_api.anthropic import (
+    ANTHROPIC_MODEL,
+    analyze_weather_trend,
+    iter_weather_trend
+)
+from weather_api.client import get_client, close_http_client
@@ -0,0 +1,410 @@
+import os
+import asyncio
+import hashlib
+import logging
+import re
+import string
+import time
+
+import httpx
+import orjson
+from cachetools import TTLCache
+
+# weather_data импортира weather_api.client, а с него и този пакет - затова зареждаме
+# weather_data като модул и взимаме функциите му при извикване
+import weather_data
+from weather_api.client import get_client
+from weather_api.single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+
+# Изтегляне на ключа от секретите на Hugging Face Spaces
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+
+if not ANTHROPIC_API_KEY:
+    logger.error("ANTHROPIC_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face Spaces.")
+
+# Конфигурация на Anthropic модела
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
+# Три кратки параграфа на кирилица - токените са повече, отколкото при английски текст,
+# затова оставяме резерв, за да не се отреже третата секция (слънчев_ден)
+ANTHROPIC_MAX_TOKENS = 400
+
+# Заглавките към Anthropic не се менят между заявките - изграждаме ги веднъж
+_ANTHROPIC_HEADERS = httpx.Headers({
+    "x-api-key": ANTHROPIC_API_KEY or "",
+    "anthropic-version": "2023-06-01",
+    "content-type": "application/json"
+})
+
+# Статичните инструкции към модела - изпращат се като системен prompt, отделно от данните.
+# Около 500 токена са под минимума от 1024 за prompt caching, затова не задаваме cache_control
+ANTHROPIC_SYSTEM_PROMPT = """Задача: Ти си професионален метеоролог, който представя времето за Обзор (древния Хелиополис) с балансирана комбинация от точност и топлота. Говориш уверено и информативно, с елегантни препратки към историята на града.
+
+Ще получиш текущ кадър от Обзор, исторически данни (вчера) и прогнозни данни (днес и утре).
+
+Моля, представи кратък и точен анализ в три части (всяка до 2-3 изречения):
+
+1. Текущо време:
+- Опиши основните характеристики: температура, облачност, морски условия
+- Сравни с вчерашния ден, отбележи значими промени
+- Избягвай прекалено поетични описания
+
+2. Влияние върху хората:
+- Как времето влияе на ежедневните дейности
+- Кратък, практичен съвет за деня
+- Фокусирай се върху полезна информация
+
+3. Оценка на "слънчевия ден":
+- Кратка оценка дали денят е "слънчев" според дефиницията
+- Елегантна препратка към историята на Хелиополис
+- Без излишна драматизация
+
+Важни изисквания:
+• Поддържай професионален, но достъпен тон
+• Избягвай прекалена емоционалност или "сладникави" описания
+• Фокусирай се върху точност и полезност
+• Включвай само релевантни детайли
+• Пази баланс между информативност и достъпност
+
+Отговорът трябва да е на български език, стегнат и професионален, без излишни украшения или преиграване."""
+
+# Шаблон на потребителското съобщение - попълва се само с данните за заявката
+_PROMPT_TMPL = string.Template("""Текущ кадър от Обзор: $video
+
+Исторически данни (вчера): $hist
+
+Прогнозни данни (днес и утре): $fcst""")
+
+# Текст за източник, чиито данни не са налични - моделът не бива да получава измислени стойности
+_NO_DATA_TEXT = "няма данни"
+
+# Номерация в началото на ред ("1.", "2)" и т.н., но не и "1.5")
+_MARKER_RE = re.compile(r"^\s*[1-3][.)](?!\d)\s*")
+# Ключови думи, по които разпознаваме трите секции от отговора
+_SECTION_RES = {
+    "analysis": re.compile(r"време|небе|температура"),
+    "influence": re.compile(r"влияние|усещане|настроение"),
+    "sunny": re.compile(r"слънчев|хелиополис")
+}
+# Ключове в отговора за всяка секция
+_SECTION_KEYS = {
+    "analysis": "анализ",
+    "influence": "влияние",
+    "sunny": "слънчев_ден"
+}
+# Текст за секция, която липсва в отговора на модела
+_SECTION_DEFAULTS = {
+    "analysis": "Времето в момента е приятно за разходка из древния Град на Слънцето.",
+    "influence": "Условията предразполагат към приятни разходки и активности на открито.",
+    "sunny": "Денят носи типичното за Хелиополис слънчево настроение."
+}
+
+# Кеш за анализите от Anthropic - входните данни се сменят рядко (на час)
+ANALYSIS_CACHE_TTL = 600
+# Данни, обновени преди по-малко от толкова секунди, не се кешират
+ANALYSIS_FRESH_DATA_WINDOW = 60
+_analysis_cache = TTLCache(maxsize=256, ttl=ANALYSIS_CACHE_TTL)
+# Анализ в изпълнение за всеки ключ и получените досега секции с опашките на чакащите
+_analysis_flights = {}
+_analysis_sections = {}
+# Последният успешен анализ - при една локация (Обзор) почти всички заявки съвпадат с него
+_last_key = None
+_last_result = None
+_last_ts = 0.0
+# Текстът от видео анализа съдържа часа на кадъра (ЧЧ:ММ), а симулираният - и случайни описания
+_VIDEO_TIME_RE = re.compile(r"\d{1,2}:\d{2}")
+_SIMULATED_VIDEO_PREFIX = "[Симулиран анализ]"
+
+def _video_cache_part(video_analysis_text):
+    """Свежда текста от видео анализа до стабилната му част - часът и случайните описания не влизат в ключа"""
+    text = video_analysis_text or ""
+    # Симулираният анализ е с произволни описания при едни и същи данни - важен е само видът му
+    if text.startswith(_SIMULATED_VIDEO_PREFIX):
+        return _SIMULATED_VIDEO_PREFIX
+    return _VIDEO_TIME_RE.sub("", text)
+
+def _analysis_cache_key(historical_data, forecast_data, video_analysis_text):
+    """Изчислява каноничен ключ за кеша от трите входни източника"""
+    # Вече декодираните речници се сериализират директно в байтове с orjson - без междинен низ и .encode()
+    raw = orjson.dumps(
+        [historical_data, forecast_data, _video_cache_part(video_analysis_text)],
+        option=orjson.OPT_SORT_KEYS,
+        default=str
+    )
+    return hashlib.blake2b(raw).hexdigest()
+
+def _is_cacheable(historical_data, forecast_data):
+    """Анализ по непълни или току-що обновени данни е краткотраен и не се кешира"""
+    if historical_data is None or forecast_data is None:
+        return False
+    last_updated = forecast_data.get("current", {}).get("last_updated_epoch")
+    if last_updated is None:
+        return True
+    return time.time() - last_updated >= ANALYSIS_FRESH_DATA_WINDOW
+
+async def analyze_weather_trend(historical_data, forecast_data, video_analysis_text):
+    """Връща анализа на тренда като речник"""
+    return {
+        name: value
+        async for name, value in iter_weather_trend(historical_data, forecast_data, video_analysis_text)
+    }
+
+async def iter_weather_trend(historical_data, forecast_data, video_analysis_text):
+    """Връща секциите на анализа една по една, като използва кеша при повторни заявки със същите данни"""
+    key = _analysis_cache_key(historical_data, forecast_data, video_analysis_text)
+
+    # Най-честият случай - същите данни като при последната заявка - минава без търсене в кеша
+    if key == _last_key and time.time() - _last_ts < ANALYSIS_CACHE_TTL:
+        logger.info("Анализът е същият като при последната заявка")
+        for item in _last_result.items():
+            yield item
+        yield "from_cache", True
+        return
+
+    cached = _analysis_cache.get(key)
+    if cached is not None:
+        logger.info("Анализът е взет от кеша")
+        for item in cached.items():
+            yield item
+        yield "from_cache", True
+        return
+
+    # Едновременните заявки със същите данни четат секциите от една обща заявка към модела
+    def start():
+        _analysis_sections[key] = ([], [])
+        return _run_analysis(key, historical_data, forecast_data, video_analysis_text)
+    task = single_flight(_analysis_flights, key, start)
+
+    sections = _analysis_sections.get(key)
+    if sections is None:
+        # Анализът току-що е завършил - връщаме готовия резултат
+        for item in (await asyncio.shield(task)).items():
+            yield item
+        return
+
+    # Вече получените секции се подават наведнъж, следващите - щом пристигнат
+    items, subscribers = sections
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    subscribers.append(queue)
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+    finally:
+        subscribers.remove(queue)
+    await asyncio.shield(task)
+
+async def _run_analysis(key, historical_data, forecast_data, video_analysis_text):
+    """Изпраща заявката към модела веднъж за всички чакащи и кешира успешния анализ"""
+    items, subscribers = _analysis_sections[key]
+
+    def publish(item):
+        items.append(item)
+        for queue in subscribers:
+            queue.put_nowait(item)
+
+    # Видео анализът, изпратен към модела, се пази с резултата - при попадение в кеша
+    # се връща той, а не новият (симулираният е с различни случайни описания)
+    result = {"видео_анализ": video_analysis_text}
+    try:
+        publish(("видео_анализ", video_analysis_text))
+        async for name, value in _stream_weather_analysis(historical_data, forecast_data, video_analysis_text):
+            result[name] = value
+            publish((name, value))
+    finally:
+        # None отбелязва края на секциите за всички чакащи
+        publish(None)
+        del _analysis_sections[key]
+
+    # Кешираме само успешните анализи
+    if result.get("статус") != "error" and _is_cacheable(historical_data, forecast_data):
+        _analysis_cache[key] = result
+        _remember_last_analysis(key, result)
+    return result
+
+def _remember_last_analysis(key, result):
+    """Запомня последния успешен анализ за бързия път в iter_weather_trend"""
+    global _last_key, _last_result, _last_ts
+    _last_key, _last_result, _last_ts = key, result, time.time()
+
+def _next_paragraph(line, current):
+    """Добавя ред към текущия параграф; връща завършения параграф, ако редът е празен или започва нова номерирана точка"""
+    marker = _MARKER_RE.match(line)
+    if marker is None and line.strip():
+        current.append(line)
+        return None
+    paragraph = "\n".join(current).strip()
+    current.clear()
+    if marker is not None:
+        # Номерацията не влиза в текста на секцията
+        current.append(line[marker.end():])
+    return paragraph or None
+
+def _classify_paragraph(paragraph, found):
+    """Определя към коя още непопълнена секция принадлежи параграфът"""
+    p_lower = paragraph.lower()
+    for name, section_re in _SECTION_RES.items():
+        if name not in found and section_re.search(p_lower):
+            return name
+    return None
+
+async def _stream_weather_analysis(historical_data, forecast_data, video_analysis_text):
+    """Изпраща данни към Anthropic API за анализ на тренда и връща секциите, докато се генерират"""
+    try:
+        if not ANTHROPIC_API_KEY:
+            logger.error("ANTHROPIC_API_KEY не е наличен")
+            # Извличаме текущата температура от прогнозните данни
+            current_temp = (forecast_data or {}).get("current", {}).get("temp_c", "N/A")
+            for item in {
+                "анализ": f"[!] AI анализът временно недостъпен (липсва API ключ). Базовите данни показват температура от {current_temp}°C в Обзор.",
+                "влияние": "[!] Поради липса на AI анализ, препоръчваме да следите метеорологичните условия от стандартната прогноза.",
+                "слънчев_ден": "[!] AI оценката за 'слънчев ден' не е налична поради липсващ API ключ.",
+                "статус": "error",
+                "error_details": "Липсва ANTHROPIC_API_KEY"
+            }.items():
+                yield item
+            return
+
+        # Форматиране на историческите данни - липсващите не се форматират като празни
+        if historical_data is None:
+            historical_text = _NO_DATA_TEXT
+        else:
+            historical_text = weather_data.format_historical_data(historical_data)
+        
+        # Форматиране на прогнозните данни
+        if forecast_data is None:
+            forecast_text = _NO_DATA_TEXT
+        else:
+            forecast_text = weather_data.format_forecast_data(forecast_data)
+        
+        # Изграждане на заявката към Claude
+        # Гарантираме, че всички параметри са низове
+        video_analysis_text_safe = video_analysis_text if video_analysis_text is not None else ""
+        historical_text_safe = historical_text if historical_text is not None else ""
+        forecast_text_safe = forecast_text if forecast_text is not None else ""
+
+        # Само данните се менят между заявките - статичните инструкции са в системния prompt
+        prompt = _PROMPT_TMPL.substitute(
+            video=video_analysis_text_safe,
+            hist=historical_text_safe,
+            fcst=forecast_text_safe
+        )
+        
+        # Логваме prompt-а преди изпращане - целият текст само на ниво DEBUG
+        logger.info("Изпращане на prompt към Anthropic API: дължина=%d, начало=%.80s", len(prompt), prompt)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Пълен prompt към Anthropic API: %r", prompt)
+
+        payload = {
+            "model": ANTHROPIC_MODEL,
+            "system": ANTHROPIC_SYSTEM_PROMPT,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": ANTHROPIC_MAX_TOKENS,
+            "temperature": 0.2,
+            "stream": True
+        }
+        
+        # Параграфите идват подред - всяка секция се връща веднага щом параграфът ѝ завърши
+        paragraphs = []
+        sections = {}
+        current = []
+        pending = ""
+        
+        client = await get_client()
+        async with client.stream(
+            "POST",
+            ANTHROPIC_API_URL,
+            content=orjson.dumps(payload),
+            headers=_ANTHROPIC_HEADERS,
+            timeout=httpx.Timeout(30.0, connect=2.0)
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                logger.error("Грешка от Anthropic API: %s", response.text)
+                error_msg = f"Технически проблем с AI анализа (код: {response.status_code})"
+                for item in {
+                    "анализ": f"[!] {error_msg}. В момента в древния Град на Слънцето времето е приятно за разходки, но нашите системи временно не могат да предоставят детайлен анализ.",
+                    "влияние": "[!] Поради техническа поддръжка на AI системите, моля проверете прогнозата от други източници. Междувременно можете да се насладите на морския бриз.",
+                    "слънчев_ден": "[!] Временно недостъпна информация поради технически проблем с AI анализа.",
+                    "статус": "error",
+                    "error_details": error_msg
+                }.items():
+                    yield item
+                return
+            
+            # Server-Sent Events - текстът идва на части в събития content_block_delta
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = orjson.loads(line[len("data:"):])
+                event_type = event.get("type")
+                
+                if event_type == "error":
+                    raise Exception(event.get("error", {}).get("message", "Грешка в потока от AI модела"))
+                if event_type == "message_delta":
+                    # Следим колко често отговорът се отрязва от лимита на токените
+                    if event.get("delta", {}).get("stop_reason") == "max_tokens":
+                        logger.warning("Отговорът от Anthropic е отрязан при max_tokens=%d", ANTHROPIC_MAX_TOKENS)
+                    continue
+                if event_type != "content_block_delta":
+                    continue
+                
+                # Един проход по завършените редове - разделяне, номерация и класификация наведнъж
+                pending += event.get("delta", {}).get("text", "")
+                *lines, pending = pending.split("\n")
+                for text_line in lines:
+                    p = _next_paragraph(text_line, current)
+                    if p:
+                        paragraphs.append(p)
+                        name = _classify_paragraph(p, sections)
+                        if name:
+                            sections[name] = p
+                            yield _SECTION_KEYS[name], p
+        
+        # Последният ред и параграф нямат завършващ празен ред
+        for text_line in (pending, ""):
+            p = _next_paragraph(text_line, current)
+            if p:
+                paragraphs.append(p)
+                name = _classify_paragraph(p, sections)
+                if name:
+                    sections[name] = p
+                    yield _SECTION_KEYS[name], p
+        
+        if not paragraphs:
+            logger.error("Няма съдържание в отговора от Anthropic")
+            raise Exception("Празен отговор от AI модела")
+        
+        logger.info("Дължина на отговора от Anthropic: %d знака в %d параграфа", sum(len(p) for p in paragraphs), len(paragraphs))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Разделени параграфи: %s", paragraphs)
+        
+        # Ако не сме намерили някоя секция, вземаме параграфите подред,
+        # а ако и такива няма - подходящо съобщение
+        for index, name in enumerate(_SECTION_KEYS):
+            if name in sections:
+                continue
+            if len(paragraphs) > index:
+                sections[name] = paragraphs[index]
+            else:
+                sections[name] = _SECTION_DEFAULTS[name]
+            yield _SECTION_KEYS[name], sections[name]
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Обработен отговор: Анализ: %s, Влияние: %s, Слънчев ден: %s", sections["analysis"], sections["influence"], sections["sunny"])
+    except Exception as e:
+        logger.error("Грешка при анализ на тренда: %s", e)
+        error_msg = f"Системна грешка: {str(e)}"
+        for item in {
+            "анализ": f"[!] {error_msg}. Базовите ни системи показват типично крайморско време в Хелиополис.",
+            "влияние": "[!] Поради технически проблем не можем да предоставим детайлен анализ. Моля, проверете други източници.",
+            "слънчев_ден": "[!] Временно недостъпна информация поради системна грешка.",
+            "статус": "error",
+            "error_details": error_msg
+        }.items():
+            yield item
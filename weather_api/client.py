@@ -0,0 +1,24 @@
+import httpx
+
+# Общ HTTP клиент с keep-alive пул - връзките към външните API се преизползват между заявките.
+# Създава се при първо използване, за да е вързан към работещия event loop
+_client = None
+
+async def get_client():
+    """Връща общия HTTP клиент, като го създава при първо използване"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            # Кратък timeout за свързване - при HTTP/2 новите връзки са рядкост
+            timeout=httpx.Timeout(10.0, connect=2.0),
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+        )
+    return _client
+
+async def close_http_client():
+    """Затваря общия HTTP клиент при спиране на приложението"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,11 +1,15 @@
 import os
-import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import logging
 import json
+import httpx
+import orjson
+
+from weather_api.client import get_client, close_http_client
+from weather_data import get_forecast_weather
 
 # Настройка на логването
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +17,10 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Weather Trend Analysis")
 
+# Общият HTTP клиент се създава при стартиране и се затваря при спиране на приложението
+app.add_event_handler("startup", get_client)
+app.add_event_handler("shutdown", close_http_client)
+
 # Добавяне на CORS middleware - Hugging Face Spaces изисква това за правилна работа
 app.add_middleware(
     CORSMiddleware,
@@ -38,47 +46,38 @@ if not HUGGING_FACE_API_KEY:
 HF_MODEL = "facebook/bart-large-cnn"  # Добър модел за обобщения
 
 async def get_weather_data(location="8250 Obzor, Bulgaria", days=1):
-    """Извлича данни за времето от WeatherAPI"""
-    try:
-        weather_url = f"http://api.weatherapi.com/v1/forecast.json?key={WEATHER_API_KEY}&q={location}&days={days}&aqi=no"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(weather_url)
-            
-            if response.status_code != 200:
-                logger.error(f"Грешка при извличане на данни за времето: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail="Неуспешно извличане на данни за времето")
-            
-            return response.json()
-    except Exception as e:
-        logger.error(f"Грешка при заявка към WeatherAPI: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Грешка при заявка към WeatherAPI: {str(e)}")
+    """Извлича данни за времето от WeatherAPI през общия кеш на прогнозите"""
+    return await get_forecast_weather(location, days, WEATHER_API_KEY)
 
 async def get_trend_from_hugging_face(weather_text):
     """Изпраща данни към Hugging Face и получава обобщение"""
     try:
-        headers = {"Authorization": f"Bearer {HUGGING_FACE_API_KEY}"}
+        headers = {
+            "Authorization": f"Bearer {HUGGING_FACE_API_KEY}",
+            "content-type": "application/json"
+        }
         url = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
         
         # Заявка към Hugging Face API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url, 
-                json={"inputs": weather_text, "parameters": {"max_length": 100, "min_length": 30}},
-                headers=headers,
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Грешка от Hugging Face API: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail="Грешка от Hugging Face модела")
-            
-            result = response.json()
-            
-            # Ако резултатът е списък (типичен формат на отговор за обобщение)
-            if isinstance(result, list) and len(result) > 0:
-                return result[0].get("summary_text", "Не можахме да генерираме обобщение.")
-            
-            return "Не можахме да разпознаем формата на отговора от модела."
+        client = await get_client()
+        response = await client.post(
+            url, 
+            content=orjson.dumps({"inputs": weather_text, "parameters": {"max_length": 100, "min_length": 30}}),
+            headers=headers,
+            timeout=httpx.Timeout(30.0, connect=2.0)
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"Грешка от Hugging Face API: {response.text}")
+            raise HTTPException(status_code=response.status_code, detail="Грешка от Hugging Face модела")
+        
+        result = orjson.loads(response.content)
+        
+        # Ако резултатът е списък (типичен формат на отговор за обобщение)
+        if isinstance(result, list) and len(result) > 0:
+            return result[0].get("summary_text", "Не можахме да генерираме обобщение.")
+        
+        return "Не можахме да разпознаем формата на отговора от модела."
     except Exception as e:
         logger.error(f"Грешка при комуникация с Hugging Face: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Грешка при комуникация с Hugging Face: {str(e)}")
@@ -106,38 +105,40 @@ def format_weather_data(weather_data):
         logger.error(f"Грешка при форматиране на данните за времето: {str(e)}")
         return "Не можахме да форматираме данните за времето."
 
+# Началната страница е статична - изграждаме отговора веднъж при зареждане
+_ROOT_RESP = HTMLResponse(content="""
+<html>
+    <head>
+        <title>Weather Trend Analysis API</title>
+        <style>
+            body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
+            h1 { color: #333; }
+            .endpoint { background: #f4f4f4; padding: 15px; border-radius: 5px; margin: 15px 0; }
+            code { background: #e0e0e0; padding: 2px 5px; border-radius: 3px; }
+        </style>
+    </head>
+    <body>
+        <h1>Weather Trend Analysis API</h1>
+        <p>Това API предоставя анализ на тенденциите в метеорологичните данни с помощта на Hugging Face модели.</p>
+        
+        <div class="endpoint">
+            <h2>Крайна точка: /weather-trend</h2>
+            <p>Получава прогноза и анализ на тенденциите на времето.</p>
+            <p>Параметри на заявката:</p>
+            <ul>
+                <li><code>location</code> (опционално): Локация за прогнозата. По подразбиране: 8250 Obzor, Bulgaria</li>
+                <li><code>days</code> (опционално): Брой дни за прогнозата. По подразбиране: 1</li>
+            </ul>
+            <p>Пример: <a href="/weather-trend?location=Sofia,Bulgaria&days=3">/weather-trend?location=Sofia,Bulgaria&days=3</a></p>
+        </div>
+    </body>
+</html>
+""")
+
 @app.get("/")
 async def root():
     """Начална страница с информация за API"""
-    html_content = """
-    <html>
-        <head>
-            <title>Weather Trend Analysis API</title>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 40px; line-height: 1.6; }
-                h1 { color: #333; }
-                .endpoint { background: #f4f4f4; padding: 15px; border-radius: 5px; margin: 15px 0; }
-                code { background: #e0e0e0; padding: 2px 5px; border-radius: 3px; }
-            </style>
-        </head>
-        <body>
-            <h1>Weather Trend Analysis API</h1>
-            <p>Това API предоставя анализ на тенденциите в метеорологичните данни с помощта на Hugging Face модели.</p>
-            
-            <div class="endpoint">
-                <h2>Крайна точка: /weather-trend</h2>
-                <p>Получава прогноза и анализ на тенденциите на времето.</p>
-                <p>Параметри на заявката:</p>
-                <ul>
-                    <li><code>location</code> (опционално): Локация за прогнозата. По подразбиране: 8250 Obzor, Bulgaria</li>
-                    <li><code>days</code> (опционално): Брой дни за прогнозата. По подразбиране: 1</li>
-                </ul>
-                <p>Пример: <a href="/weather-trend?location=Sofia,Bulgaria&days=3">/weather-trend?location=Sofia,Bulgaria&days=3</a></p>
-            </div>
-        </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+    return _ROOT_RESP
 
 @app.get("/weather-trend")
 async def weather_trend(location: str = "8250 Obzor, Bulgaria", days: int = 1):
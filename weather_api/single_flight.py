@@ -0,0 +1,21 @@
+import asyncio
+
+def single_flight(registry, key, coro_factory):
+    """Връща задачата за ключа, като я стартира само ако в registry още няма такава.
+
+    Задачата не принадлежи на никой от чакащите - те я чакат през asyncio.shield,
+    затова прекъсната заявка не спира работата за останалите
+    """
+    task = registry.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coro_factory())
+        registry[key] = task
+        task.add_done_callback(lambda t: _forget(registry, key, t))
+    return task
+
+def _forget(registry, key, task):
+    """Премахва приключилата задача; прочита грешката ѝ, ако всички чакащи са се отказали"""
+    if registry.get(key) is task:
+        del registry[key]
+    if not task.cancelled():
+        task.exception()
@@ -1,12 +1,103 @@
-import httpx
 from fastapi import HTTPException
+from weather_api.client import get_client
+from weather_api.single_flight import single_flight
 import logging
+import asyncio
+import copy
+import orjson
 from datetime import datetime, timedelta
+from cachetools import TTLCache
 
-# Настройка на логването
-logging.basicConfig(level=logging.INFO)
+# Логването се настройва от входната точка на приложението
 logger = logging.getLogger(__name__)
 
+# Адреси на WeatherAPI - параметрите се подават отделно, а TLS сесията се преизползва от общия клиент
+_HISTORY_BASE = "https://api.weatherapi.com/v1/history.json"
+_FORECAST_BASE = "https://api.weatherapi.com/v1/forecast.json"
+
+# Кеш за отговорите от WeatherAPI - вчерашните данни практически не се променят,
+# а прогнозата се обновява на около 15 минути
+HISTORY_CACHE_TTL = 3600
+FORECAST_CACHE_TTL = 600
+_history_cache = TTLCache(maxsize=128, ttl=HISTORY_CACHE_TTL)
+_forecast_cache = TTLCache(maxsize=128, ttl=FORECAST_CACHE_TTL)
+# Задача за всеки ключ, който в момента се изтегля - едновременните заявки чакат нея
+_fetch_tasks = {}
+
+# Най-много толкова едновременни заявки към WeatherAPI от един процес
+WEATHER_API_CONCURRENCY = 8
+_weather_sem = None
+
+def _get_weather_sem():
+    """Създава семафора при първо използване, за да е вързан към работещия event loop"""
+    global _weather_sem
+    if _weather_sem is None:
+        _weather_sem = asyncio.Semaphore(WEATHER_API_CONCURRENCY)
+    return _weather_sem
+
+# Коефициент за превръщане на км/ч в м/с
+_KPH_TO_MS = 1.0 / 3.6
+
+# Имена на дните в прогнозата - WeatherAPI връща най-много 14 дни
+_DAY_NAMES = ("Днес", "Утре") + tuple(f"След {i} дни" for i in range(2, 16))
+
+# Кеш за форматирания текст - еднаквите данни в рамките на TTL се форматират само веднъж
+FORMAT_CACHE_TTL = 600
+_format_cache = TTLCache(maxsize=128, ttl=FORMAT_CACHE_TTL)
+# Текстът за вчерашния ден не зависи от обновяванията на прогнозата - пази се по-дълго и отделно
+HISTORY_FORMAT_CACHE_TTL = 7200
+_history_format_cache = TTLCache(maxsize=64, ttl=HISTORY_FORMAT_CACHE_TTL)
+
+# Общ празен речник за липсващи вложени полета - не се променя, само се чете
+_EMPTY = {}
+
+# Полетата от отговора на WeatherAPI, които реално използваме
+# Регионът и координатите различават едноименни места в ключовете на кеша за форматиран текст
+_LOCATION_FIELDS = ("name", "region", "country", "lat", "lon")
+_CURRENT_FIELDS = ("temp_c", "condition", "last_updated_epoch")
+_DAY_FIELDS = (
+    "avgtemp_c", "mintemp_c", "maxtemp_c", "condition",
+    "totalprecip_mm", "avghumidity", "maxwind_kph", "daily_chance_of_rain"
+)
+
+def _pick(data, fields):
+    """Връща само избраните ключове от речника"""
+    return {key: data[key] for key in fields if key in data}
+
+def _location_key(location):
+    """Идентифицира мястото в ключовете на кеша - само по име едноименните места се смесват"""
+    return tuple(location.get(field) for field in _LOCATION_FIELDS)
+
+def _extract_fields(weather_data):
+    """Оставя само полетата, които форматираме - почасовите данни са по-голямата част от отговора"""
+    slim = {
+        "location": _pick(weather_data.get("location", {}), _LOCATION_FIELDS),
+        "forecast": {
+            "forecastday": [
+                {"date": day.get("date"), "day": _pick(day.get("day", {}), _DAY_FIELDS)}
+                for day in weather_data.get("forecast", {}).get("forecastday", [])
+            ]
+        }
+    }
+    if "current" in weather_data:
+        slim["current"] = _pick(weather_data["current"], _CURRENT_FIELDS)
+    return slim
+
+async def _cached_fetch(cache, cache_key, fetch):
+    """Връща данните от кеша или ги изтегля веднъж за всички едновременни заявки със същия ключ"""
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    task = single_flight(_fetch_tasks, cache_key, lambda: _fetch_and_store(cache, cache_key, fetch))
+    return copy.deepcopy(await asyncio.shield(task))
+
+async def _fetch_and_store(cache, cache_key, fetch):
+    """Изтегля данните и ги записва в кеша; грешките не се кешират"""
+    data = await fetch()
+    cache[cache_key] = data
+    return data
+
 async def get_historical_weather(location="8250 Obzor, Bulgaria", weather_api_key=None):
     """Извлича данни за времето от предишния ден"""
     try:
@@ -16,19 +107,24 @@ async def get_historical_weather(location="8250 Obzor, Bulgaria", weather_api_ke
         # Изчисляваме датата за вчерашния ден
         yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
         
-        # Заявка за исторически данни
-        history_url = f"http://api.weatherapi.com/v1/history.json?key={weather_api_key}&q={location}&dt={yesterday}&lang=bg"
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(history_url)
+        async def fetch():
+            # Заявка за исторически данни
+            client = await get_client()
+            async with _get_weather_sem():
+                response = await client.get(
+                    _HISTORY_BASE,
+                    params={"key": weather_api_key, "q": location, "dt": yesterday, "lang": "bg"}
+                )
             
             if response.status_code != 200:
-                logger.error(f"Грешка при извличане на исторически данни: {response.text}")
+                logger.error("Грешка при извличане на исторически данни: %s", response.text)
                 raise HTTPException(status_code=response.status_code, detail="Неуспешно извличане на исторически данни")
             
-            return response.json()
+            return _extract_fields(orjson.loads(response.content))
+        
+        return await _cached_fetch(_history_cache, ("history", location, yesterday), fetch)
     except Exception as e:
-        logger.error(f"Грешка при заявка за исторически данни: {str(e)}")
+        logger.error("Грешка при заявка за исторически данни: %s", e)
         raise HTTPException(status_code=500, detail=f"Грешка при заявка за исторически данни: {str(e)}")
 
 async def get_forecast_weather(location="8250 Obzor, Bulgaria", days=1, weather_api_key=None):
@@ -37,72 +133,128 @@ async def get_forecast_weather(location="8250 Obzor, Bulgaria", days=1, weather_
         if not weather_api_key:
             raise ValueError("WEATHER_API_KEY не е предоставен")
             
-        forecast_url = f"http://api.weatherapi.com/v1/forecast.json?key={weather_api_key}&q={location}&days={days}&lang=bg"
+        # Датата влиза в ключа, за да не се ползва вчерашна прогноза след полунощ
+        today = datetime.now().strftime('%Y-%m-%d')
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(forecast_url)
+        async def fetch():
+            client = await get_client()
+            async with _get_weather_sem():
+                response = await client.get(
+                    _FORECAST_BASE,
+                    # Без качество на въздуха и предупреждения - не ги използваме, а уголемяват отговора
+                    params={"key": weather_api_key, "q": location, "days": days, "lang": "bg", "aqi": "no", "alerts": "no"}
+                )
             
             if response.status_code != 200:
-                logger.error(f"Грешка при извличане на прогнозни данни: {response.text}")
+                logger.error("Грешка при извличане на прогнозни данни: %s", response.text)
                 raise HTTPException(status_code=response.status_code, detail="Неуспешно извличане на прогнозни данни")
             
-            return response.json()
+            return _extract_fields(orjson.loads(response.content))
+        
+        return await _cached_fetch(_forecast_cache, ("forecast", location, days, today), fetch)
     except Exception as e:
-        logger.error(f"Грешка при заявка за прогнозни данни: {str(e)}")
+        logger.error("Грешка при заявка за прогнозни данни: %s", e)
         raise HTTPException(status_code=500, detail=f"Грешка при заявка за прогнозни данни: {str(e)}")
 
+async def get_all_weather(location="8250 Obzor, Bulgaria", days=1, weather_api_key=None):
+    """Извлича паралелно историческите и прогнозните данни; при неуспех на едното връща None на негово място"""
+    historical_data, forecast_data = await asyncio.gather(
+        get_historical_weather(location, weather_api_key),
+        get_forecast_weather(location, days, weather_api_key),
+        return_exceptions=True
+    )
+
+    # Ако няма нито исторически, нито прогнозни данни, няма с какво да продължим
+    if isinstance(historical_data, Exception) and isinstance(forecast_data, Exception):
+        raise forecast_data
+
+    if isinstance(historical_data, Exception):
+        logger.error("Историческите данни не са налични: %s", historical_data)
+        historical_data = None
+    if isinstance(forecast_data, Exception):
+        logger.error("Прогнозните данни не са налични: %s", forecast_data)
+        forecast_data = None
+
+    return historical_data, forecast_data
+
 def format_historical_data(weather_data):
     """Форматира историческите данни за времето"""
     try:
         location = weather_data.get("location", {})
         forecast_day = weather_data.get("forecast", {}).get("forecastday", [{}])[0]
         day_data = forecast_day.get("day", {})
+        cond = day_data.get("condition") or _EMPTY
         
-        # Конвертиране на скоростта на вятъра от км/ч в м/с
-        wind_speed_ms = round(day_data.get('maxwind_kph', 0) / 3.6, 1)
+        # Данните за даден ден и локация не се променят
+        cache_key = None
+        if forecast_day.get("date") is not None:
+            cache_key = (_location_key(location), forecast_day.get("date"))
+            cached = _history_format_cache.get(cache_key)
+            if cached is not None:
+                return cached
         
-        text = f"Местоположение: {location.get('name')}, {location.get('country')}. "
-        text += f"Средна температура: {day_data.get('avgtemp_c')}°C. "
-        text += f"Минимална температура: {day_data.get('mintemp_c')}°C. "
-        text += f"Максимална температура: {day_data.get('maxtemp_c')}°C. "
-        text += f"Условия: {day_data.get('condition', {}).get('text')}. "
-        text += f"Валежи: {day_data.get('totalprecip_mm')} мм. "
-        text += f"Средна влажност: {day_data.get('avghumidity')}%. "
-        text += f"Максимална скорост на вятъра: {wind_speed_ms} м/с."
+        text = "".join([
+            f"Местоположение: {location.get('name')}, {location.get('country')}. ",
+            f"Средна температура: {day_data.get('avgtemp_c')}°C. ",
+            f"Минимална температура: {day_data.get('mintemp_c')}°C. ",
+            f"Максимална температура: {day_data.get('maxtemp_c')}°C. ",
+            f"Условия: {cond.get('text')}. ",
+            f"Валежи: {day_data.get('totalprecip_mm')} мм. ",
+            f"Средна влажност: {day_data.get('avghumidity')}%. ",
+            # Конвертиране на скоростта на вятъра от км/ч в м/с
+            f"Максимална скорост на вятъра: {day_data.get('maxwind_kph', 0) * _KPH_TO_MS:.1f} м/с."
+        ])
         
+        if cache_key is not None:
+            _history_format_cache[cache_key] = text
         return text
     except Exception as e:
-        logger.error(f"Грешка при форматиране на историческите данни: {str(e)}")
+        logger.error("Грешка при форматиране на историческите данни: %s", e)
         return "Не можахме да форматираме историческите данни."
 
 def format_forecast_data(weather_data):
     """Форматира прогнозните данни за времето"""
     try:
         location = weather_data.get("location", {})
-        current = weather_data.get("current", {})
+        current = weather_data.get("current") or _EMPTY
+        current_cond = current.get("condition") or _EMPTY
         forecast_days = weather_data.get("forecast", {}).get("forecastday", [])
         
-        text = f"Местоположение: {location.get('name')}, {location.get('country')}. "
-        text += f"Текущо време: Температура {current.get('temp_c')}°C, {current.get('condition', {}).get('text')}. "
+        # Прогнозата се сменя само когато WeatherAPI обнови текущите данни
+        cache_key = None
+        if current.get("last_updated_epoch") is not None:
+            cache_key = ("forecast", _location_key(location), current.get("last_updated_epoch"), len(forecast_days))
+            cached = _format_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        parts = [
+            f"Местоположение: {location.get('name')}, {location.get('country')}. ",
+            f"Текущо време: Температура {current.get('temp_c')}°C, {current_cond.get('text')}. "
+        ]
         
         for i, day in enumerate(forecast_days):
-            day_name = "Днес" if i == 0 else "Утре" if i == 1 else f"След {i} дни"
+            day_name = _DAY_NAMES[i] if i < len(_DAY_NAMES) else f"След {i} дни"
             date = day.get("date")
             day_data = day.get("day", {})
+            cond = day_data.get("condition") or _EMPTY
             
-            # Конвертиране на скоростта на вятъра от км/ч в м/с
-            wind_speed_ms = round(day_data.get('maxwind_kph', 0) / 3.6, 1)
-            
-            text += f"{day_name} ({date}): "
-            text += f"Минимална температура: {day_data.get('mintemp_c')}°C, "
-            text += f"Максимална температура: {day_data.get('maxtemp_c')}°C, "
-            text += f"Условия: {day_data.get('condition', {}).get('text')}, "
-            text += f"Вероятност за валеж: {day_data.get('daily_chance_of_rain')}%, "
-            text += f"Очаквани валежи: {day_data.get('totalprecip_mm')} мм, "
-            text += f"Влажност: {day_data.get('avghumidity')}%, "
-            text += f"Скорост на вятъра: {wind_speed_ms} м/с. "
+            parts.append(
+                f"{day_name} ({date}): "
+                f"Минимална температура: {day_data.get('mintemp_c')}°C, "
+                f"Максимална температура: {day_data.get('maxtemp_c')}°C, "
+                f"Условия: {cond.get('text')}, "
+                f"Вероятност за валеж: {day_data.get('daily_chance_of_rain')}%, "
+                f"Очаквани валежи: {day_data.get('totalprecip_mm')} мм, "
+                f"Влажност: {day_data.get('avghumidity')}%, "
+                # Конвертиране на скоростта на вятъра от км/ч в м/с
+                f"Скорост на вятъра: {day_data.get('maxwind_kph', 0) * _KPH_TO_MS:.1f} м/с. "
+            )
         
+        text = "".join(parts)
+        if cache_key is not None:
+            _format_cache[cache_key] = text
         return text
     except Exception as e:
-        logger.error(f"Грешка при форматиране на прогнозните данни: {str(e)}")
+        logger.error("Грешка при форматиране на прогнозните данни: %s", e)
         return "Не можахме да форматираме прогнозните данни."
\ No newline at end of file